@@ -1,9 +1,16 @@
 # dxf_layout_engine.py
+import io
 import os
 import ezdxf
+from ezdxf import recover
+from ezdxf.addons.importer import Importer
 import re
+import tempfile
 import datetime
 from collections import defaultdict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 from typing import Optional, List, Tuple, Any
 
 # Adicionando prints para depuração
@@ -18,7 +25,7 @@ except ImportError as e:
     raise # Re-levanta o erro para que o traceback seja claro
 
 try:
-    from google_drive_utils import baixar_arquivo_drive, upload_to_drive, buscar_arquivo_personalizado_por_id_e_sku
+    from google_drive_utils import baixar_arquivo_drive, baixar_arquivo_drive_bytes, upload_to_drive, buscar_arquivo_personalizado_por_id_e_sku, buscar_arquivos_personalizados_em_lote
     print("DEBUG: dxf_layout_engine.py - google_drive_utils importado com sucesso.")
 except ImportError as e:
     print(f"ERROR: dxf_layout_engine.py - Falha ao importar google_drive_utils: {e}")
@@ -32,6 +39,19 @@ class NoEntitiesFoundError(Exception):
     pass
 # --- Fim da Exceção Customizada ---
 
+@dataclass(slots=True)
+class ItemLayout:
+    """
+    Registro de um item já ingerido: o bloco registrado no documento de saída
+    e as dimensões do seu bounding box. Slots fixos em vez de dict: menos
+    memória por item e acesso a campo sem hash de chave nos loops de layout.
+    """
+    block_name: str
+    sku: str
+    bbox_width: float
+    bbox_height: float
+    id_arquivo_drive: str # ID lógico, mantido para rastreamento de falhas
+
 # --- Configurações de Layout (em mm) ---
 # Tamanho da folha de corte (exemplo: A0 ou um tamanho personalizado)
 FOLHA_LARGURA_MM, FOLHA_ALTURA_MM = 1200, 900 # Exemplo: 1.2m x 0.9m
@@ -40,6 +60,7 @@ FOLHA_LARGURA_MM, FOLHA_ALTURA_MM = 1200, 900 # Exemplo: 1.2m x 0.9m
 ESPACAMENTO_DXF_MESMO_FURO = 100.0  # Espaçamento horizontal entre DXFs do mesmo tipo de furo
 ESPACAMENTO_LINHA_COR = 200.0       # Espaçamento vertical entre linhas de cores diferentes
 ESPACAMENTO_PLANO_COR = 100.0       # Espaçamento vertical entre o DXF do plano e a primeira linha de cor
+ESPACAMENTO_SHELF_MESMA_COR = 100.0 # Espaçamento vertical entre prateleiras da mesma cor (quebra de linha)
 
 # Margens da folha
 MARGEM_ESQUERDA = 50
@@ -67,6 +88,18 @@ ESPACAMENTO_SEPARADOR_POST_BARRA = 100.0 # Espaçamento depois da barra
 # Use esta variável para corrigir pequenas variações na distância percebida da barra.
 ADJUSTMENT_OFFSET_BARRA_MM = 250.0
 
+# Número máximo de downloads simultâneos do Google Drive por plano.
+# O gargalo aqui é latência de rede, então os downloads são paralelizados.
+MAX_DOWNLOAD_WORKERS = 8
+
+# Nome do bloco da barra separadora no documento de saída
+BARRA_BLOCK_NAME = "BARRA_SEPARADORA"
+
+# Logs [DEBUG] por item dos loops quentes (ingestão e posicionamento) só são
+# emitidos com DXF_DEBUG=1. Cada print em container é formatação de f-string
+# mais um flush de stdout; em planos grandes isso vira milhares de syscalls.
+DEBUG_LOGS = os.getenv("DXF_DEBUG", "0") == "1"
+
 # Variável global para armazenar as entidades da barra
 barra_entities = []
 barra_width = BARRA_DXF_FIXED_WIDTH_MM
@@ -75,64 +108,215 @@ barra_original_min_x, barra_original_min_y = 0.0, 0.0
 
 print("DEBUG: dxf_layout_engine.py - Variáveis globais e constantes definidas.")
 
+# Cache dos templates locais (Plano_Info/<plan_name>.dxf e Barra.dxf) já
+# analisados, com o mtime do arquivo na época do parse. O mesmo template é usado
+# em requisições sucessivas, então o parse é feito uma única vez — mas um
+# arquivo atualizado no disco (mtime diferente) invalida a entrada e é
+# re-analisado. Barra e planos passam pelo mesmo caminho de carga.
+_template_cache = {} # caminho -> (mtime, resultado)
+
+def _carregar_template_dxf(caminho_dxf: str, largura_fixa: float, altura_fixa: float):
+    """
+    Carrega (com cache invalidado por mtime) as entidades e dimensões de um DXF
+    de template local (plano de corte ou barra separadora).
+    Retorna (entities, width, height, original_min_x, original_min_y).
+    Em caso de arquivo ausente ou inválido, retorna lista vazia e dimensões 0.
+    """
+    try:
+        mtime_atual = os.path.getmtime(caminho_dxf)
+    except OSError:
+        mtime_atual = None
+
+    cached = _template_cache.get(caminho_dxf)
+    if cached is not None and cached[0] == mtime_atual:
+        print(f"DEBUG: _carregar_template_dxf() - Template '{caminho_dxf}' obtido do cache.")
+        return cached[1]
+
+    template_width = 0
+    template_height = 0
+    template_entities = [] # Lista para armazenar as entidades do template
+    template_min_x, template_min_y = 0.0, 0.0
+
+    # EAFP: abre direto e trata a ausência como exceção, em vez de pagar um
+    # stat de os.path.exists antes de cada open (o arquivo existir é o caso comum).
+    try:
+        try:
+            template_doc = ezdxf.readfile(caminho_dxf)
+        except ezdxf.DXFStructureError:
+            # Arquivo parcialmente corrompido: o caminho rápido falhou, mas o
+            # módulo recover ainda pode reconstruir o que for recuperável em
+            # vez de descartar o template inteiro.
+            print(f"[WARN] DXF '{caminho_dxf}' inválido na leitura normal. Tentando ezdxf.recover...")
+            template_doc, _auditor = recover.readfile(caminho_dxf)
+        template_msp = template_doc.modelspace()
+
+        min_x, min_y, max_x, max_y = calcular_bbox_dxf(template_msp)
+        template_width = max_x - min_x
+        template_height = max_y - min_y
+        template_min_x, template_min_y = min_x, min_y
+
+        # --- Fallback para dimensões fixas se bbox for 0x0 ---
+        if template_width == 0.0 and template_height == 0.0:
+            print(f"[WARN] Dimensões de '{caminho_dxf}' calculadas como 0x0. Usando dimensões fixas: {largura_fixa}x{altura_fixa} mm.")
+            template_width = largura_fixa
+            template_height = altura_fixa
+            template_min_x, template_min_y = 0.0, 0.0 # Reinicia offset se usar fixo
+        # --- Fim do Fallback ---
+
+        for ent in template_msp:
+            template_entities.append(ent.copy()) # Copia para evitar referências ao doc original
+
+        print(f"[INFO] Template DXF '{caminho_dxf}' carregado. Dimensões: {template_width:.2f}x{template_height:.2f} mm")
+
+    except FileNotFoundError:
+        print(f"[WARN] Template DXF '{caminho_dxf}' não encontrado localmente. Não será inserido.")
+    except ezdxf.DXFStructureError as e:
+        print(f"[ERROR] Arquivo DXF '{caminho_dxf}' corrompido ou inválido: {e}. Não será inserido.")
+        template_entities = [] # Limpa as entidades se houver erro
+    except Exception as e:
+        print(f"[ERROR] Erro ao carregar DXF '{caminho_dxf}': {e}. Não será inserido.")
+        template_entities = [] # Limpa as entidades se houver erro
+
+    resultado = (template_entities, template_width, template_height, template_min_x, template_min_y)
+    # Só entra no cache o que foi carregado com sucesso; ausência/erro é re-tentado na próxima chamada.
+    if template_entities:
+        _template_cache[caminho_dxf] = (mtime_atual, resultado)
+    return resultado
+
 def load_barra_dxf():
-    """Carrega as entidades do Barra.dxf uma vez."""
+    """Carrega as entidades do Barra.dxf (mesmo caminho de carga dos templates de plano)."""
     global barra_entities, barra_width, barra_height, barra_original_min_x, barra_original_min_y
-    print("DEBUG: load_barra_dxf() - Chamado.")
-    if not barra_entities: # Carrega apenas se ainda não foi carregado
-        print(f"DEBUG: load_barra_dxf() - Barra DXF não carregada, tentando carregar de '{BARRA_DXF_PATH}'.")
-        if os.path.exists(BARRA_DXF_PATH):
-            try:
-                barra_doc = ezdxf.readfile(BARRA_DXF_PATH)
-                barra_msp = barra_doc.modelspace()
-                
-                min_x_barra, min_y_barra, max_x_barra, max_y_barra = calcular_bbox_dxf(barra_msp)
-                
-                # Fallback para dimensões fixas se bbox for 0x0
-                if (max_x_barra - min_x_barra) == 0.0 and (max_y_barra - min_y_barra) == 0.0:
-                    print(f"[WARN] Dimensões de Barra.dxf calculadas como 0x0. Usando dimensões fixas: {BARRA_DXF_FIXED_WIDTH_MM}x{BARRA_DXF_FIXED_HEIGHT_MM} mm.")
-                    barra_width = BARRA_DXF_FIXED_WIDTH_MM
-                    barra_height = BARRA_DXF_FIXED_HEIGHT_MM
-                    barra_original_min_x, barra_original_min_y = 0.0, 0.0
-                else:
-                    barra_width = max_x_barra - min_x_barra
-                    barra_height = max_y_barra - min_y_barra
-                    barra_original_min_x, barra_original_min_y = min_x_barra, min_y_barra
-
-                for ent in barra_msp:
-                    barra_entities.append(ent.copy())
-                print(f"[INFO] Barra.dxf carregado. Dimensões: {barra_width:.2f}x{barra_height:.2f} mm")
-            except ezdxf.DXFStructureError as e:
-                print(f"[ERROR] Arquivo DXF '{BARRA_DXF_PATH}' corrompido ou inválido: {e}")
-                barra_entities = []
-            except Exception as e:
-                print(f"[ERROR] Erro ao carregar DXF '{BARRA_DXF_PATH}': {e}")
-                barra_entities = []
-        else:
-            print(f"[WARN] Barra.dxf não encontrado em '{BARRA_DXF_PATH}'. Separadores não serão inseridos.")
-    else:
+    if barra_entities: # Carrega apenas se ainda não foi carregado
         print("DEBUG: load_barra_dxf() - Barra DXF já carregada.")
+        return
+    entities, width, height, min_x, min_y = _carregar_template_dxf(
+        BARRA_DXF_PATH, BARRA_DXF_FIXED_WIDTH_MM, BARRA_DXF_FIXED_HEIGHT_MM)
+    if entities:
+        barra_entities = entities
+        barra_width, barra_height = width, height
+        barra_original_min_x, barra_original_min_y = min_x, min_y
+    else:
+        print(f"[WARN] Barra.dxf não disponível em '{BARRA_DXF_PATH}'. Separadores não serão inseridos.")
 
 print("DEBUG: dxf_layout_engine.py - load_barra_dxf() definida.")
 
+def _carregar_plano_template(plan_name: str):
+    """
+    Carrega as entidades e dimensões do DXF do plano de corte via cache de templates.
+    Retorna (entities, width, height, original_min_x, original_min_y).
+    """
+    return _carregar_template_dxf(
+        os.path.join("Plano_Info", f"{plan_name}.dxf"),
+        PLANO_DXF_FIXED_WIDTH_MM, PLANO_DXF_FIXED_HEIGHT_MM)
+
+def _nome_bloco(nome: str) -> str:
+    """Sanitiza um nome para uso como nome de bloco DXF (sem caracteres inválidos)."""
+    return re.sub(r'[^A-Za-z0-9_\-]', '_', nome)
+
+def _garantir_bloco(doc, block_name: str, entities, origin_min_x: float, origin_min_y: float):
+    """
+    Garante que o bloco exista no documento de saída, com as entidades
+    normalizadas para que o canto inferior esquerdo do conteúdo fique em (0,0).
+    Assim, inserir o bloco em (x, y) posiciona o canto inferior esquerdo em (x, y).
+    Se o bloco já existe (arquivo repetido), nada é copiado de novo.
+
+    Quando a origem é um layout com documento (ex: modelspace de um item recém
+    lido), usa o Importer do ezdxf, que copia em lote e traz junto os recursos
+    (layers, linetypes, estilos de texto) referenciados pelas entidades.
+    """
+    if block_name in doc.blocks:
+        if DEBUG_LOGS:
+            print(f"DEBUG: _garantir_bloco() - Bloco '{block_name}' já existe, reutilizando.")
+        return
+    blk = doc.blocks.new(name=block_name)
+
+    source_doc = getattr(entities, 'doc', None)
+    if source_doc is not None:
+        importer = Importer(source_doc, doc)
+        importer.import_entities(entities, blk)
+        importer.finalize()
+        for ent in blk:
+            ent.translate(-origin_min_x, -origin_min_y, 0)
+    else:
+        # Listas de entidades já desvinculadas (templates de barra/plano em cache)
+        for ent in entities:
+            new_ent = ent.copy()
+            new_ent.translate(-origin_min_x, -origin_min_y, 0)
+            blk.add_entity(new_ent)
+
+def _buscar_baixar_e_ler_item(item_data: dict, local_dxf_name: str, drive_folder_id: str, prefetch: Optional[dict] = None, dir_destino: Optional[str] = None):
+    """
+    Busca o arquivo personalizado de um item no Drive, baixa, faz o parse do DXF
+    e calcula seu bounding box. Executada em paralelo (uma thread por item):
+    além do I/O de rede, o parse do ezdxf de itens diferentes é independente,
+    então também sobrepõe bem entre threads.
+    Se 'prefetch' (dict target_id -> (file_id, nome)) for fornecido, a busca
+    individual no Drive só acontece para IDs fora dele. Os downloads vão para
+    'dir_destino', cuja remoção fica a cargo do chamador.
+    Retorna (item_doc, min_x, min_y, max_x, max_y).
+    """
+    target_id_from_sheet = item_data['id_arquivo_drive']
+    sku = item_data['sku']
+    prefetched = prefetch.get(target_id_from_sheet) if prefetch else None
+    if prefetched is not None:
+        real_file_id, nome_arquivo_drive = prefetched
+    else:
+        if DEBUG_LOGS:
+            print(f"DEBUG: Calling buscar_arquivo_personalizado_por_id_e_sku for target_id={target_id_from_sheet}, sku={sku}")
+        real_file_id, nome_arquivo_drive = buscar_arquivo_personalizado_por_id_e_sku(
+            target_id=target_id_from_sheet,
+            sku=sku,
+            drive_folder_id=drive_folder_id
+        )
+    print(f"[INFO] Arquivo encontrado no Drive: ID real='{real_file_id}', Nome='{nome_arquivo_drive}'")
+    raw = baixar_arquivo_drive_bytes(real_file_id, drive_folder_id)
+    if raw.startswith(b"AutoCAD Binary DXF"):
+        # DXF binário só é lido pelo ezdxf a partir de arquivo; grava no
+        # diretório temporário do plano apenas nesse caso (raro).
+        dxf_path_local = os.path.join(dir_destino or tempfile.gettempdir(), local_dxf_name)
+        with open(dxf_path_local, 'wb') as f:
+            f.write(raw)
+        item_doc = ezdxf.readfile(dxf_path_local)
+    else:
+        try:
+            item_doc = ezdxf.read(io.StringIO(raw.decode('utf-8')))
+        except (UnicodeDecodeError, ezdxf.DXFStructureError):
+            # Encoding não-UTF-8 ou arquivo parcialmente corrompido: o módulo
+            # recover detecta o encoding e reconstrói o que for recuperável.
+            print(f"[WARN] DXF para SKU '{sku}' inválido na leitura normal. Tentando ezdxf.recover...")
+            item_doc, _auditor = recover.read(io.BytesIO(raw))
+    min_x, min_y, max_x, max_y = calcular_bbox_dxf(item_doc.modelspace())
+    return item_doc, min_x, min_y, max_x, max_y
+
 def generate_single_plan_layout_data(
     file_ids_and_skus: list[dict],
     plan_name: str,
     drive_folder_id: str,
-) -> Tuple[List[Tuple[Any, float, float]], float, float, List[str]]: # Retorna List[str] para failed_ids
+    doc: Any,
+    item_cache: Optional[dict] = None,
+) -> Tuple[List[Tuple[str, float, float]], float, float, List[str]]: # Retorna List[str] para failed_ids
     """
-    Gera as entidades DXF e suas posições relativas para o layout de um único plano de corte,
+    Gera os posicionamentos de blocos DXF para o layout de um único plano de corte,
     assumindo que o canto inferior esquerdo do layout final será (0,0).
 
+    Cada arquivo DXF único vira UM bloco no documento de saída; cada posicionamento
+    é apenas uma referência (INSERT) a esse bloco. Arquivos repetidos não duplicam
+    entidades no documento final.
+
     Args:
         file_ids_and_skus: Lista de dicionários, cada um com 'id_arquivo_drive' (ID lógico do nome) do Drive
                            e 'sku' correspondente.
         plan_name: Nome do plano de corte (ex: "01", "A").
         drive_folder_id: ID da pasta principal do Google Drive.
+        doc: Documento ezdxf de saída, onde os blocos são registrados.
+        item_cache: Dicionário (target_id, sku) -> (largura, altura) compartilhado
+                    entre os planos de uma mesma requisição. Itens já ingeridos em
+                    um plano anterior não são buscados, baixados nem re-analisados:
+                    o bloco já está em 'doc' e as dimensões vêm do cache.
 
     Returns:
         Uma tupla contendo:
-        - Uma lista de tuplas: (entidade ezdxf copiada, x_pos_relativa, y_pos_relativa)
+        - Uma lista de tuplas: (nome do bloco, x_pos_relativa, y_pos_relativa)
         - A largura total do layout do plano.
         - A altura total do layout do plano.
         - Uma lista dos 'id_arquivo_drive' que falharam ao serem processados.
@@ -142,381 +326,361 @@ def generate_single_plan_layout_data(
     # Carrega a barra DXF se ainda não foi carregada
     load_barra_dxf()
 
-    # Usaremos um documento temporário para calcular as posições relativas
-    # e depois copiaremos as entidades para o documento principal no main.py
-    temp_doc = ezdxf.new('R2010')
-    temp_doc.header['$INSUNITS'] = 4  # Define a unidade como Milímetros (4)
-    temp_msp = temp_doc.modelspace()
+    # Estrutura para organizar os DXFs por cor, formato, tamanho e furo.
+    # Chave achatada (cor, formato, tamanho, furo) -> lista de itens; a estrutura
+    # só é percorrida em ordem de chave, nunca acessada por chave parcial, então
+    # um dict plano evita os 4 níveis de hash/aninhamento por inserção.
+    # { ('DOU','PLAC','3010','2FH'): [ {block_name, sku, bbox_width, bbox_height, id_arquivo_drive}, ... ] }
+    organized_dxfs = {}
+
+    # Altura máxima de item por cor, acumulada durante a ingestão — evita
+    # varrer a estrutura aninhada de novo a cada linha de cor no layout.
+    max_item_height_per_color = defaultdict(float)
 
-    # Estrutura para organizar os DXFs por cor, formato, tamanho e furo
-    # { 'DOU': { 'PLAC': { '3010': { '2FH': [ {dxf_entity, original_sku, bbox_width, bbox_height, original_min_x, original_min_y}, ... ] } } } }
-    organized_dxfs = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(list))))
-    
     failed_ids_current_plan = [] # Nova lista para IDs de arquivos que falharam neste plano
 
     # --- 1. Baixar e Organizar DXFs de Itens ---
     print(f"[INFO] Baixando e organizando DXFs de itens para o plano '{plan_name}'...")
-    for item_data in file_ids_and_skus:
-        target_id_from_sheet = item_data['id_arquivo_drive'] 
-        sku = item_data['sku']
-        
-        print(f"DEBUG: Processing SKU: {sku} (ID: {target_id_from_sheet})")
-        dxf_format, dxf_size, hole_type, color_code = parse_sku(sku)
-        print(f"DEBUG: parse_sku returned: format={dxf_format}, size={dxf_size}, hole={hole_type}, color={color_code}")
-
-        if not dxf_format or not dxf_size or not hole_type or not color_code:
-            print(f"[WARN] SKU '{sku}' (ID: {target_id_from_sheet}) inválido ou incompleto, ignorando item e adicionando ID a falhas.")
-            failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
-            continue
 
-        try:
-            print(f"DEBUG: Calling buscar_arquivo_personalizado_por_id_e_sku for target_id={target_id_from_sheet}, sku={sku}")
-            result_from_search = buscar_arquivo_personalizado_por_id_e_sku(
-                target_id=target_id_from_sheet,
-                sku=sku,
-                drive_folder_id=drive_folder_id
-            )
-            print(f"DEBUG: buscar_arquivo_personalizado_por_id_e_sku returned: {result_from_search}")
-            real_file_id, nome_arquivo_drive = result_from_search
-            print(f"[INFO] Arquivo encontrado no Drive: ID real='{real_file_id}', Nome='{nome_arquivo_drive}'")
-        except FileNotFoundError as e:
-            print(f"[ERROR] Falha ao encontrar arquivo no Drive para ID lógico '{target_id_from_sheet}' e SKU '{sku}': {e}. Adicionando ID a falhas.")
-            failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
-            continue
-        except Exception as e:
-            print(f"[ERROR] Erro inesperado ao buscar arquivo no Drive para ID lógico '{target_id_from_sheet}' e SKU '{sku}': {e}. Adicionando ID a falhas.")
-            failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
-            continue
-
-        local_dxf_name = f"{sku}.dxf"
-        try:
-            dxf_path_local = baixar_arquivo_drive(real_file_id, local_dxf_name, drive_folder_id)
-        except Exception as e:
-            print(f"[ERROR] Falha ao baixar DXF para SKU '{sku}' (ID real: {real_file_id}): {e}. Adicionando ID a falhas.")
-            failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
-            continue
+    # Resolve os IDs lógicos de todos os itens em uma única consulta ao Drive
+    # (files.list com cláusulas 'or'), em vez de uma consulta por item. IDs não
+    # resolvidos aqui caem na busca individual dentro do worker.
+    # Itens já resolvidos por um plano anterior desta requisição ficam fora da consulta.
+    ids_para_resolver = [
+        item['id_arquivo_drive'] for item in file_ids_and_skus
+        if item_cache is None or (item['id_arquivo_drive'], item['sku']) not in item_cache
+    ]
+    try:
+        prefetch = buscar_arquivos_personalizados_em_lote(ids_para_resolver, drive_folder_id) \
+            if ids_para_resolver else {}
+    except Exception as e:
+        print(f"[WARN] Falha na busca em lote no Drive: {e}. Usando busca individual por item.")
+        prefetch = {}
+
+    # 1a. Valida os SKUs e dispara download+parse em paralelo.
+    download_jobs = [] # (item_data, campos do SKU, future do download+parse)
+    futures_por_target = {} # target_id -> future; o mesmo arquivo não é baixado duas vezes
+    # Um único diretório temporário por plano recebe todos os downloads; uma
+    # remoção na saída do bloco substitui um unlink por item no caminho quente.
+    with tempfile.TemporaryDirectory(prefix="dxfjob_") as download_dir, \
+            ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        for job_index, item_data in enumerate(file_ids_and_skus):
+            target_id_from_sheet = item_data['id_arquivo_drive']
+            sku = item_data['sku']
+
+            dxf_format, dxf_size, hole_type, color_code = parse_sku(sku)
+            if DEBUG_LOGS:
+                print(f"DEBUG: parse_sku returned for SKU {sku}: format={dxf_format}, size={dxf_size}, hole={hole_type}, color={color_code}")
+
+            if not dxf_format or not dxf_size or not hole_type or not color_code:
+                print(f"[WARN] SKU '{sku}' (ID: {target_id_from_sheet}) inválido ou incompleto, ignorando item e adicionando ID a falhas.")
+                failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
+                continue
 
-        try:
-            item_doc = ezdxf.readfile(dxf_path_local)
-            item_msp = item_doc.modelspace()
-            min_x, min_y, max_x, max_y = calcular_bbox_dxf(item_msp)
-            
-            dxf_width = max_x - min_x
-            dxf_height = max_y - min_y
-
-            # --- Fallback para dimensões fixas se bbox for 0x0 (Adicionado) ---
-            if dxf_width == 0.0 and dxf_height == 0.0:
-                print(f"[WARN] Dimensões de SKU '{sku}' (ID: {target_id_from_sheet}) calculadas como 0x0. Usando dimensões fixas: {ITEM_DXF_FIXED_WIDTH_MM}x{ITEM_DXF_FIXED_HEIGHT_MM} mm.")
-                dxf_width = ITEM_DXF_FIXED_WIDTH_MM
-                dxf_height = ITEM_DXF_FIXED_HEIGHT_MM
-                # Para o offset, assumimos que o ponto de origem do desenho é (0,0) se não houver bbox válido
-                min_x, min_y = 0.0, 0.0 
-            # --- Fim do Fallback ---
-
-            entities_to_add = []
-            for entity in item_msp:
-                entities_to_add.append(entity.copy()) # Copia para evitar referências ao doc original
-
-            if not entities_to_add: # Se o DXF foi lido mas não tem entidades visíveis
-                print(f"[WARN] DXF para SKU '{sku}' (ID: {target_id_from_sheet}) não contém entidades visíveis. Adicionando ID a falhas.")
-                failed_ids_current_plan.append(target_id_from_sheet)
+            # Item já ingerido por um plano anterior desta requisição: o bloco
+            # está no documento de saída e o bbox está no cache — nada a baixar.
+            if item_cache is not None and (target_id_from_sheet, sku) in item_cache:
+                download_jobs.append((item_data, dxf_format, dxf_size, hole_type, color_code, None))
                 continue
 
-            organized_dxfs[color_code][dxf_format][dxf_size][hole_type].append({
-                'entities': entities_to_add,
-                'sku': sku,
-                'bbox_width': dxf_width,
-                'bbox_height': dxf_height,
-                'original_min_x': min_x,
-                'original_min_y': min_y,
-                'id_arquivo_drive': target_id_from_sheet # Adiciona o ID aqui para rastreamento
-            })
-            print(f"[INFO] DXF para SKU '{sku}' (ID: {target_id_from_sheet}, cor: {color_code}, formato: {dxf_format}, tamanho: {dxf_size}, furo: {hole_type}) processado. Dimensões: {dxf_width:.2f}x{dxf_height:.2f} mm")
-
-        except ezdxf.DXFStructureError as e:
-            print(f"[ERROR] Arquivo DXF '{dxf_path_local}' corrompido ou inválido: {e}. Adicionando ID a falhas.")
-            failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
-        except Exception as e:
-            print(f"[ERROR] Erro ao processar DXF '{dxf_path_local}': {e}. Adicionando ID a falhas.")
-            failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
-        finally:
-            if os.path.exists(dxf_path_local):
-                os.remove(dxf_path_local)
+            # O mesmo ID lógico repetido no plano compartilha um único
+            # download+parse; Future.result() pode ser consumido N vezes.
+            future = futures_por_target.get(target_id_from_sheet)
+            if future is None:
+                # Nome local único por job, para que downloads paralelos do mesmo SKU não colidam
+                local_dxf_name = f"{plan_name}_{job_index:03d}_{sku}.dxf"
+                future = executor.submit(_buscar_baixar_e_ler_item, item_data, local_dxf_name, drive_folder_id, prefetch, download_dir)
+                futures_por_target[target_id_from_sheet] = future
+            download_jobs.append((item_data, dxf_format, dxf_size, hole_type, color_code, future))
+
+        # 1b. Consome os resultados na ordem de submissão e registra cada DXF lido.
+        # A falha de um download/parse afeta apenas o item correspondente.
+        for item_data, dxf_format, dxf_size, hole_type, color_code, future in download_jobs:
+            target_id_from_sheet = item_data['id_arquivo_drive']
+            sku = item_data['sku']
+
+            if future is None:
+                # Reuso entre planos: bloco já registrado, dimensões do cache.
+                dxf_width, dxf_height = item_cache[(target_id_from_sheet, sku)]
+                block_name = _nome_bloco(f"ITEM_{target_id_from_sheet}_{sku}")
+                organized_dxfs.setdefault((color_code, dxf_format, dxf_size, hole_type), []).append(
+                    ItemLayout(
+                        block_name=block_name,
+                        sku=sku,
+                        bbox_width=dxf_width,
+                        bbox_height=dxf_height,
+                        id_arquivo_drive=target_id_from_sheet,
+                    ))
+                max_item_height_per_color[color_code] = max(max_item_height_per_color[color_code], dxf_height)
+                if DEBUG_LOGS:
+                    print(f"DEBUG: Item SKU '{sku}' (ID: {target_id_from_sheet}) reutilizado do cache de planos anteriores.")
+                continue
 
-    # --- 2. Preparar DXF do Plano de Corte ---
-    plano_info_dxf_path = os.path.join("Plano_Info", f"{plan_name}.dxf")
-    
-    plano_width = 0
-    plano_height = 0
-    plano_entities = [] # Lista para armazenar as entidades do plano
-    plano_original_min_x, plano_original_min_y = 0.0, 0.0
+            try:
+                item_doc, min_x, min_y, max_x, max_y = future.result()
+            except FileNotFoundError as e:
+                print(f"[ERROR] Falha ao encontrar arquivo no Drive para ID lógico '{target_id_from_sheet}' e SKU '{sku}': {e}. Adicionando ID a falhas.")
+                failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
+                continue
+            except ezdxf.DXFStructureError as e:
+                print(f"[ERROR] Arquivo DXF para SKU '{sku}' (ID: {target_id_from_sheet}) corrompido ou inválido: {e}. Adicionando ID a falhas.")
+                failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
+                continue
+            except Exception as e:
+                print(f"[ERROR] Falha ao buscar/baixar/ler DXF para SKU '{sku}' (ID: {target_id_from_sheet}): {e}. Adicionando ID a falhas.")
+                failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
+                continue
 
-    if os.path.exists(plano_info_dxf_path):
-        try:
-            plano_doc = ezdxf.readfile(plano_info_dxf_path)
-            plano_msp = plano_doc.modelspace()
-            
-            min_x_plano, min_y_plano, max_x_plano, max_y_plano = calcular_bbox_dxf(plano_msp)
-            plano_width = max_x_plano - min_x_plano
-            plano_height = max_y_plano - min_y_plano
-            plano_original_min_x, plano_original_min_y = min_x_plano, min_y_plano
-
-            # --- Fallback para dimensões fixas se bbox for 0x0 (Adicionado) ---
-            if plano_width == 0.0 and plano_height == 0.0:
-                print(f"[WARN] Dimensões do plano '{plan_name}.dxf' calculadas como 0x0. Usando dimensões fixas: {PLANO_DXF_FIXED_WIDTH_MM}x{PLANO_DXF_FIXED_HEIGHT_MM} mm.")
-                plano_width = PLANO_DXF_FIXED_WIDTH_MM
-                plano_height = PLANO_DXF_FIXED_HEIGHT_MM
-                plano_original_min_x, plano_original_min_y = 0.0, 0.0 # Reinicia offset se usar fixo
-            # --- Fim do Fallback ---
-
-            for ent in plano_msp:
-                plano_entities.append(ent.copy()) # Copia para evitar referências ao doc original
-            
-            print(f"[INFO] DXF do plano de corte '{plano_info_dxf_path}' carregado. Dimensões: {plano_width:.2f}x{plano_height:.2f} mm")
-
-        except ezdxf.DXFStructureError as e:
-            print(f"[ERROR] Arquivo DXF do plano de corte '{plano_info_dxf_path}' corrompido ou inválido: {e}. Plano não será inserido.")
-            plano_entities = [] # Limpa as entidades se houver erro
-        except Exception as e:
-            print(f"[ERROR] Erro ao carregar DXF do plano de corte '{plano_info_dxf_path}': {e}. Plano não será inserido.")
-            plano_entities = [] # Limpa as entidades se houver erro
-    else:
-        print(f"[WARN] DXF do plano de corte '{plano_info_dxf_path}' não encontrado localmente. Não será inserido.")
+            try:
+                item_msp = item_doc.modelspace()
+                dxf_width = max_x - min_x
+                dxf_height = max_y - min_y
+
+                # --- Fallback para dimensões fixas se bbox for 0x0 (Adicionado) ---
+                if dxf_width == 0.0 and dxf_height == 0.0:
+                    print(f"[WARN] Dimensões de SKU '{sku}' (ID: {target_id_from_sheet}) calculadas como 0x0. Usando dimensões fixas: {ITEM_DXF_FIXED_WIDTH_MM}x{ITEM_DXF_FIXED_HEIGHT_MM} mm.")
+                    dxf_width = ITEM_DXF_FIXED_WIDTH_MM
+                    dxf_height = ITEM_DXF_FIXED_HEIGHT_MM
+                    # Para o offset, assumimos que o ponto de origem do desenho é (0,0) se não houver bbox válido
+                    min_x, min_y = 0.0, 0.0 
+                # --- Fim do Fallback ---
+
+                if len(item_msp) == 0: # Se o DXF foi lido mas não tem entidades visíveis
+                    print(f"[WARN] DXF para SKU '{sku}' (ID: {target_id_from_sheet}) não contém entidades visíveis. Adicionando ID a falhas.")
+                    failed_ids_current_plan.append(target_id_from_sheet)
+                    continue
+
+                # Registra o arquivo como um bloco único no documento de saída.
+                # O ID lógico entra no nome porque dois pedidos podem compartilhar
+                # o mesmo SKU com personalizações diferentes.
+                block_name = _nome_bloco(f"ITEM_{target_id_from_sheet}_{sku}")
+                _garantir_bloco(doc, block_name, item_msp, min_x, min_y)
+
+                organized_dxfs.setdefault((color_code, dxf_format, dxf_size, hole_type), []).append(
+                    ItemLayout(
+                        block_name=block_name,
+                        sku=sku,
+                        bbox_width=dxf_width,
+                        bbox_height=dxf_height,
+                        id_arquivo_drive=target_id_from_sheet,
+                    ))
+                max_item_height_per_color[color_code] = max(max_item_height_per_color[color_code], dxf_height)
+                if item_cache is not None:
+                    item_cache[(target_id_from_sheet, sku)] = (dxf_width, dxf_height)
+                print(f"[INFO] DXF para SKU '{sku}' (ID: {target_id_from_sheet}, cor: {color_code}, formato: {dxf_format}, tamanho: {dxf_size}, furo: {hole_type}) processado. Dimensões: {dxf_width:.2f}x{dxf_height:.2f} mm")
 
-    # --- 3. Posicionar e Coletar Entidades no Modelspace Relativo ---
-    
-    # Esta lista armazenará todas as entidades com suas posições finais RELATIVAS
-    # ao canto inferior esquerdo do layout deste plano (que será (0,0) após o ajuste final)
-    all_relative_entities_with_coords = []
+            except Exception as e:
+                print(f"[ERROR] Erro ao processar DXF do SKU '{sku}' (ID: {target_id_from_sheet}): {e}. Adicionando ID a falhas.")
+                failed_ids_current_plan.append(target_id_from_sheet) # Adiciona ID à lista de falhas
+
+    # --- 2. Preparar DXF do Plano de Corte ---
+    plano_entities, plano_width, plano_height, plano_original_min_x, plano_original_min_y = \
+        _carregar_plano_template(plan_name)
 
-    # Altura total estimada para o layout deste plano (primeira passagem para estimar altura)
-    estimated_layout_height = 0
+    plano_block_name = _nome_bloco(f"PLANO_{plan_name}")
     if plano_entities:
-        estimated_layout_height += plano_height + ESPACAMENTO_PLANO_COR
-    
-    # Adiciona a altura de cada linha de cor + espaçamento
-    for color_code in sorted(organized_dxfs.keys()):
-        color_group = organized_dxfs[color_code]
-        max_height_in_color_line = 0
-        
-        if barra_entities: # Considera a altura da barra se ela for inserida
-            max_height_in_color_line = max(max_height_in_color_line, barra_height)
+        _garantir_bloco(doc, plano_block_name, plano_entities, plano_original_min_x, plano_original_min_y)
 
-        for dxf_format in sorted(color_group.keys()):
-            format_group = color_group[dxf_format]
-            for dxf_size in sorted(format_group.keys()):
-                size_group = format_group[dxf_size]
-                for hole_type in size_group.keys():
-                    for dxf_item in size_group[hole_type]:
-                        max_height_in_color_line = max(max_height_in_color_line, dxf_item['bbox_height'])
-        
-        # Se houver itens nesta linha de cor, adiciona a altura máxima e o espaçamento da linha de cor
-        if max_height_in_color_line > 0:
-            estimated_layout_height += max_height_in_color_line + ESPACAMENTO_LINHA_COR
-    
-    # Remove o último espaçamento de linha de cor, pois não há próxima linha
-    if organized_dxfs and estimated_layout_height > 0:
-        estimated_layout_height -= ESPACAMENTO_LINHA_COR
-    
-    # Se não houver itens nem plano, definimos uma altura mínima para evitar 0
-    if estimated_layout_height == 0:
-        estimated_layout_height = 1 # Altura mínima para um layout vazio
+    # --- 3. Posicionar Elementos (apenas aritmética de offsets, sem copiar entidades) ---
+
+    # Cada posicionamento guarda (nome do bloco, x, y) — a emissão final é só um
+    # INSERT por posicionamento, sem copiar entidade alguma.
+    pending_placements = []
 
-    # Agora, posicionamos os elementos de cima para baixo.
-    current_y_pos_for_new_row = estimated_layout_height - MARGEM_INFERIOR # Começa do topo do espaço disponível
+    # Bounding box analítico do layout, acumulado a partir das dimensões já conhecidas
+    # de cada elemento posicionado (dispensa recalcular o bbox de todas as entidades no final).
+    layout_min_x = layout_min_y = None
+    layout_max_x = layout_max_y = None
+
+    def _registrar_posicao(x0, y0, largura, altura):
+        """Acumula o bbox analítico do layout a partir de um retângulo posicionado."""
+        nonlocal layout_min_x, layout_min_y, layout_max_x, layout_max_y
+        if layout_min_x is None:
+            layout_min_x, layout_min_y = x0, y0
+            layout_max_x, layout_max_y = x0 + largura, y0 + altura
+        else:
+            layout_min_x = min(layout_min_x, x0)
+            layout_min_y = min(layout_min_y, y0)
+            layout_max_x = max(layout_max_x, x0 + largura)
+            layout_max_y = max(layout_max_y, y0 + altura)
+
+    def _quebrar_shelf_se_necessario(largura_necessaria, current_x_pos, row_base_y, shelf_height):
+        """
+        Quebra a linha (shelf) quando o próximo elemento estouraria a largura da
+        folha, continuando a mesma cor em uma nova prateleira logo abaixo.
+        Retorna (current_x_pos, row_base_y), possivelmente atualizados.
+        """
+        if current_x_pos > MARGEM_ESQUERDA and current_x_pos + largura_necessaria > FOLHA_LARGURA_MM:
+            row_base_y -= shelf_height + ESPACAMENTO_SHELF_MESMA_COR
+            current_x_pos = MARGEM_ESQUERDA
+            if DEBUG_LOGS:
+                print(f"[DEBUG] Largura da folha excedida; nova prateleira na mesma cor. Base Y: {row_base_y:.2f} mm")
+        return current_x_pos, row_base_y
+
+    def _inserir_barra_separadora(contexto, current_x_pos, row_base_y, shelf_height):
+        """Posiciona a Barra.dxf como separador e retorna (novo cursor X, base Y da prateleira)."""
+        if barra_entities:
+            if DEBUG_LOGS:
+                print(f"DEBUG: Inserindo Barra.dxf antes de {contexto}. current_x_pos antes: {current_x_pos:.2f} mm")
+            current_x_pos, row_base_y = _quebrar_shelf_se_necessario(
+                ESPACAMENTO_SEPARADOR_PRE_BARRA + barra_width, current_x_pos, row_base_y, shelf_height)
+            current_x_pos += ESPACAMENTO_SEPARADOR_PRE_BARRA
+            _garantir_bloco(doc, BARRA_BLOCK_NAME, barra_entities, barra_original_min_x, barra_original_min_y)
+            pending_placements.append((BARRA_BLOCK_NAME, current_x_pos, row_base_y))
+            _registrar_posicao(current_x_pos, row_base_y, barra_width, barra_height)
+            if DEBUG_LOGS:
+                print(f"[DEBUG] Barra.dxf inserida em X:{current_x_pos:.2f}, Y:{row_base_y:.2f}. Largura da barra: {barra_width:.2f} mm.")
+            current_x_pos += barra_width + ESPACAMENTO_SEPARADOR_POST_BARRA + ADJUSTMENT_OFFSET_BARRA_MM # Avança X pela largura da barra + espaçamento + ajuste
+        else:
+            current_x_pos += ESPACAMENTO_DXF_MESMO_FURO # Fallback se a barra não for carregada
+        if DEBUG_LOGS:
+            print(f"DEBUG: current_x_pos após barra (ou fallback) e espaçamento: {current_x_pos:.2f} mm")
+        return current_x_pos, row_base_y
+
+    # Posicionamos os elementos de cima para baixo a partir de uma origem
+    # arbitrária (Y=0 no topo, cursor descendo para valores negativos). A
+    # normalização final desloca tudo para o canto (0,0), então não é preciso
+    # estimar a altura total antes de posicionar.
+    current_y_pos_for_new_row = 0.0
 
     # Inserir o DXF do plano de corte no topo, se houver
     if plano_entities:
         plano_insert_y = current_y_pos_for_new_row - plano_height
-        
-        offset_x_plano = MARGEM_ESQUERDA - plano_original_min_x
-        offset_y_plano = plano_insert_y - plano_original_min_y
 
-        for ent in plano_entities:
-            new_ent = ent.copy()
-            new_ent.translate(offset_x_plano, offset_y_plano, 0)
-            all_relative_entities_with_coords.append((new_ent, new_ent.dxf.insert.x if hasattr(new_ent.dxf, 'insert') else offset_x_plano, new_ent.dxf.insert.y if hasattr(new_ent.dxf, 'insert') else offset_y_plano))
-        
-        print(f"[DEBUG] Plano de corte '{plan_name}.dxf' inserido em X:{MARGEM_ESQUERDA:.2f}, Y:{plano_insert_y:.2f} (relativo).")
-        
+        pending_placements.append((plano_block_name, MARGEM_ESQUERDA, plano_insert_y))
+        _registrar_posicao(MARGEM_ESQUERDA, plano_insert_y, plano_width, plano_height)
+
+        if DEBUG_LOGS:
+            print(f"[DEBUG] Plano de corte '{plan_name}.dxf' inserido em X:{MARGEM_ESQUERDA:.2f}, Y:{plano_insert_y:.2f} (relativo).")
+
         current_y_pos_for_new_row = plano_insert_y - ESPACAMENTO_PLANO_COR
-        print(f"[DEBUG] Cursor Y após plano de corte: {current_y_pos_for_new_row:.2f} mm (abaixo do plano + espaçamento)")
-    else:
+        if DEBUG_LOGS:
+            print(f"[DEBUG] Cursor Y após plano de corte: {current_y_pos_for_new_row:.2f} mm (abaixo do plano + espaçamento)")
+    elif DEBUG_LOGS:
         print("[DEBUG] Nenhum DXF de plano de corte para inserir.")
 
 
-    # Ordenar cores para um layout consistente (ex: alfabético)
-    sorted_colors = sorted(organized_dxfs.keys())
-
-    for color_code in sorted_colors:
-        color_group = organized_dxfs[color_code]
+    # Percurso pré-ordenado do agrupamento, construído uma única vez:
+    # [(cor, [(formato, [(tamanho, [(furo, itens ordenados por SKU)])])])]
+    # Uma única ordenação das chaves achatadas reproduz a ordem
+    # cor > formato > tamanho > furo; o groupby recupera a hierarquia
+    # para o loop de posicionamento sem re-ordenar nada.
+    sorted_rows = sorted(organized_dxfs.items())
+    layout_traversal = []
+    for color_code, color_rows in groupby(sorted_rows, key=lambda kv: kv[0][0]):
+        color_traversal = []
+        for dxf_format, format_rows in groupby(color_rows, key=lambda kv: kv[0][1]):
+            format_traversal = []
+            for dxf_size, size_rows in groupby(format_rows, key=lambda kv: kv[0][2]):
+                # Dentro do grupo de furo, itens em altura decrescente (NFDH):
+                # os mais altos abrem a prateleira e os baixos preenchem o fim,
+                # então a quebra de shelf desperdiça menos altura. SKU como
+                # critério secundário mantém a ordem estável entre execuções.
+                size_traversal = [
+                    (key[3], sorted(items, key=lambda x: (-x.bbox_height, x.sku)))
+                    for key, items in size_rows
+                ]
+                format_traversal.append((dxf_size, size_traversal))
+            color_traversal.append((dxf_format, format_traversal))
+        layout_traversal.append((color_code, color_traversal))
+
+    for color_code, color_traversal in layout_traversal:
         current_x_pos = MARGEM_ESQUERDA # Reseta X para cada nova linha de cor
-        
-        # Encontra a altura máxima dos DXFs nesta linha de cor para determinar o avanço vertical
-        max_height_in_color_line = 0
+
+        # Altura máxima dos DXFs nesta linha de cor (pré-computada na ingestão)
+        # para determinar o avanço vertical
+        max_height_in_color_line = max_item_height_per_color[color_code]
         if barra_entities:
             max_height_in_color_line = max(max_height_in_color_line, barra_height)
 
-        for dxf_format in sorted(color_group.keys()):
-            format_group = color_group[dxf_format]
-            for dxf_size in sorted(format_group.keys()):
-                size_group = format_group[dxf_size]
-                for hole_type in size_group.keys():
-                    for dxf_item in size_group[hole_type]:
-                        max_height_in_color_line = max(max_height_in_color_line, dxf_item['bbox_height'])
-
         # A posição Y para esta linha de cor (canto inferior esquerdo dos itens)
         row_base_y = current_y_pos_for_new_row - max_height_in_color_line
-        print(f"[DEBUG] Iniciando linha de cor '{color_code}'. Altura máx na linha: {max_height_in_color_line:.2f} mm. Base Y da linha: {row_base_y:.2f} mm")
-        
-        sorted_formats = sorted(color_group.keys())
+        if DEBUG_LOGS:
+            print(f"[DEBUG] Iniciando linha de cor '{color_code}'. Altura máx na linha: {max_height_in_color_line:.2f} mm. Base Y da linha: {row_base_y:.2f} mm")
+
         first_format_in_line = True
-        for dxf_format in sorted_formats:
-            format_group = color_group[dxf_format]
+        for dxf_format, format_traversal in color_traversal:
 
             if not first_format_in_line:
                 # Inserir separador antes de um novo formato
-                if barra_entities:
-                    print(f"DEBUG: Inserindo Barra.dxf antes do novo formato '{dxf_format}'. current_x_pos antes: {current_x_pos:.2f} mm")
-                    current_x_pos += ESPACAMENTO_SEPARADOR_PRE_BARRA
-                    offset_x_barra = current_x_pos - barra_original_min_x
-                    offset_y_barra = row_base_y - barra_original_min_y 
-                    
-                    for ent in barra_entities:
-                        new_ent = ent.copy()
-                        new_ent.translate(offset_x_barra, offset_y_barra, 0)
-                        all_relative_entities_with_coords.append((new_ent, new_ent.dxf.insert.x if hasattr(new_ent.dxf, 'insert') else offset_x_barra, new_ent.dxf.insert.y if hasattr(new_ent.dxf, 'insert') else offset_y_barra))
-                    print(f"[DEBUG] Barra.dxf inserida em X:{current_x_pos:.2f}, Y:{offset_y_barra:.2f}. Largura da barra: {barra_width:.2f} mm.")
-                    current_x_pos += barra_width + ESPACAMENTO_SEPARADOR_POST_BARRA + ADJUSTMENT_OFFSET_BARRA_MM # Avança X pela largura da barra + espaçamento + ajuste
-                else:
-                    current_x_pos += ESPACAMENTO_DXF_MESMO_FURO # Fallback se a barra não for carregada
-                print(f"[DEBUG] current_x_pos após barra (ou fallback) e espaçamento: {current_x_pos:.2f} mm")
-            
-            sorted_sizes = sorted(format_group.keys())
+                current_x_pos, row_base_y = _inserir_barra_separadora(f"o novo formato '{dxf_format}'", current_x_pos, row_base_y, max_height_in_color_line)
+
             first_size_in_format = True
-            for dxf_size in sorted_sizes:
-                size_group = format_group[dxf_size]
+            for dxf_size, size_traversal in format_traversal:
 
                 if not first_size_in_format:
                     # Inserir separador antes de um novo tamanho
-                    if barra_entities:
-                        print(f"DEBUG: Inserindo Barra.dxf antes do novo tamanho '{dxf_size}'. current_x_pos antes: {current_x_pos:.2f} mm")
-                        current_x_pos += ESPACAMENTO_SEPARADOR_PRE_BARRA
-                        offset_x_barra = current_x_pos - barra_original_min_x
-                        offset_y_barra = row_base_y - barra_original_min_y
-                        for ent in barra_entities:
-                            new_ent = ent.copy()
-                            new_ent.translate(offset_x_barra, offset_y_barra, 0)
-                            all_relative_entities_with_coords.append((new_ent, new_ent.dxf.insert.x if hasattr(new_ent.dxf, 'insert') else offset_x_barra, new_ent.dxf.insert.y if hasattr(new_ent.dxf, 'insert') else offset_y_barra))
-                        print(f"[DEBUG] Barra.dxf inserida em X:{current_x_pos:.2f}, Y:{offset_y_barra:.2f}. Largura da barra: {barra_width:.2f} mm.")
-                        current_x_pos += barra_width + ESPACAMENTO_SEPARADOR_POST_BARRA + ADJUSTMENT_OFFSET_BARRA_MM
-                    else:
-                        current_x_pos += ESPACAMENTO_DXF_MESMO_FURO
-                    print(f"DEBUG: current_x_pos após barra (ou fallback) e espaçamento: {current_x_pos:.2f} mm")
-
-                sorted_hole_types = sorted(size_group.keys())
+                    current_x_pos, row_base_y = _inserir_barra_separadora(f"o novo tamanho '{dxf_size}'", current_x_pos, row_base_y, max_height_in_color_line)
+
                 first_hole_type_in_size = True
-                for hole_type in sorted_hole_types:
-                    hole_type_group = size_group[hole_type]
-                    
+                for hole_type, sorted_hole_type_dxfs in size_traversal:
+
                     if not first_hole_type_in_size:
                         # Inserir separador antes de um novo tipo de furo
-                        if barra_entities:
-                            print(f"DEBUG: Inserindo Barra.dxf antes do novo furo '{hole_type}'. current_x_pos antes: {current_x_pos:.2f} mm")
-                            current_x_pos += ESPACAMENTO_SEPARADOR_PRE_BARRA
-                            offset_x_barra = current_x_pos - barra_original_min_x
-                            offset_y_barra = row_base_y - barra_original_min_y
-                            for ent in barra_entities:
-                                new_ent = ent.copy()
-                                new_ent.translate(offset_x_barra, offset_y_barra, 0)
-                                all_relative_entities_with_coords.append((new_ent, new_ent.dxf.insert.x if hasattr(new_ent.dxf, 'insert') else offset_x_barra, new_ent.dxf.insert.y if hasattr(new_ent.dxf, 'insert') else offset_y_barra))
-                            print(f"[DEBUG] Barra.dxf inserida em X:{current_x_pos:.2f}, Y:{offset_y_barra:.2f}. Largura da barra: {barra_width:.2f} mm.")
-                            current_x_pos += barra_width + ESPACAMENTO_SEPARADOR_POST_BARRA + ADJUSTMENT_OFFSET_BARRA_MM
-                        else:
-                            current_x_pos += ESPACAMENTO_DXF_MESMO_FURO
-                        print(f"DEBUG: current_x_pos após barra (ou fallback) e espaçamento: {current_x_pos:.2f} mm")
-                    
-                    # Ordenar DXFs dentro do grupo de furo (opcional, mas bom para consistência)
-                    sorted_hole_type_dxfs = sorted(hole_type_group, key=lambda x: x['sku'])
+                        current_x_pos, row_base_y = _inserir_barra_separadora(f"o novo furo '{hole_type}'", current_x_pos, row_base_y, max_height_in_color_line)
 
                     first_dxf_in_group = True
                     for dxf_item in sorted_hole_type_dxfs:
-                        entities = dxf_item['entities']
-                        sku = dxf_item['sku']
-                        bbox_width = dxf_item['bbox_width']
-                        bbox_height = dxf_item['bbox_height']
-                        original_min_x = dxf_item['original_min_x']
-                        original_min_y = dxf_item['original_min_y']
+                        block_name = dxf_item.block_name
+                        sku = dxf_item.sku
+                        bbox_width = dxf_item.bbox_width
+                        bbox_height = dxf_item.bbox_height
 
                         if not first_dxf_in_group:
-                            print(f"DEBUG: Adding ESPACAMENTO_DXF_MESMO_FURO ({ESPACAMENTO_DXF_MESMO_FURO:.2f} mm). current_x_pos before: {current_x_pos:.2f} mm")
                             current_x_pos += ESPACAMENTO_DXF_MESMO_FURO # Espaçamento entre DXFs do mesmo furo
-                            print(f"DEBUG: current_x_pos after ESPACAMENTO_DXF_MESMO_FURO: {current_x_pos:.2f} mm")
-
-                        # Calcular offset para mover o DXF para a posição atual (current_x_pos, row_base_y)
-                        offset_x = current_x_pos - original_min_x
-                        offset_y = row_base_y - original_min_y # Usar row_base_y para alinhar a base da linha
-
-                        for ent in entities:
-                            new_ent = ent.copy()
-                            new_ent.translate(offset_x, offset_y, 0)
-                            all_relative_entities_with_coords.append((new_ent, new_ent.dxf.insert.x if hasattr(new_ent.dxf, 'insert') else offset_x, new_ent.dxf.insert.y if hasattr(new_ent.dxf, 'insert') else offset_y))
-                        
-                        print(f"[DEBUG] Item '{sku}' inserido em X:{current_x_pos:.2f}, Y:{row_base_y:.2f} (relativo). Largura do item: {bbox_width:.2f} mm.")
+
+                        # Quebra para uma nova prateleira se o item não couber na folha
+                        current_x_pos, row_base_y = _quebrar_shelf_se_necessario(
+                            bbox_width, current_x_pos, row_base_y, max_height_in_color_line)
+
+                        # O bloco é normalizado na origem, então o INSERT vai direto
+                        # na posição atual (current_x_pos, row_base_y)
+                        pending_placements.append((block_name, current_x_pos, row_base_y))
+                        _registrar_posicao(current_x_pos, row_base_y, bbox_width, bbox_height)
+
+                        if DEBUG_LOGS:
+                            print(f"[DEBUG] Item '{sku}' inserido em X:{current_x_pos:.2f}, Y:{row_base_y:.2f} (relativo). Largura do item: {bbox_width:.2f} mm.")
                         current_x_pos += bbox_width # Avança X pela largura do DXF
-                        print(f"DEBUG: current_x_pos after item '{sku}' (width {bbox_width:.2f}): {current_x_pos:.2f} mm")
                         first_dxf_in_group = False
-                    
+
                     first_hole_type_in_size = False
                 first_size_in_format = False
             first_format_in_line = False
-        
+
         # Após processar todos os furos para uma cor, avança Y para a próxima linha de cor
         current_y_pos_for_new_row = row_base_y - ESPACAMENTO_LINHA_COR
-        print(f"[DEBUG] Cursor Y após linha de cor '{color_code}': {current_y_pos_for_new_row:.2f} mm (abaixo da linha + espaçamento)")
+        if DEBUG_LOGS:
+            print(f"[DEBUG] Cursor Y após linha de cor '{color_code}': {current_y_pos_for_new_row:.2f} mm (abaixo da linha + espaçamento)")
 
-    # --- 4. Calcular Bounding Box Final do Layout do Plano e Ajustar para (0,0) ---
-    min_x_layout, min_y_layout, max_x_layout, max_y_layout = 0, 0, 0, 0
-    
-    if all_relative_entities_with_coords:
-        from ezdxf.math import BoundingBox
-        layout_bbox = BoundingBox()
-
-        # Adiciona todas as entidades ao temp_msp para calcular o bbox
-        for ent, _, _ in all_relative_entities_with_coords:
-            temp_msp.add_entity(ent) # Adiciona a entidade já com a posição relativa calculada
-
-        min_x_layout, min_y_layout, max_x_layout, max_y_layout = calcular_bbox_dxf(temp_msp)
-
-        if min_x_layout == max_x_layout and min_y_layout == max_y_layout and len(all_relative_entities_with_coords) > 0:
-            print("[WARN] Bounding box final do layout do plano ainda é 0x0. Pode haver entidades sem geometria. Retornando dimensões estimadas.")
-            # Se o bbox ainda for 0x0, mas há entidades, usamos as dimensões estimadas para o layout
-            # e não levantamos NoEntitiesFoundError aqui, pois queremos que o DXF seja gerado (mesmo que com problemas visuais).
-            layout_width = MARGEM_ESQUERDA * 2 + 100 # Exemplo de largura mínima
-            layout_height = estimated_layout_height # Usa a altura estimada
-            return [(ent, x, y) for ent, x, y in all_relative_entities_with_coords], layout_width, layout_height, failed_ids_current_plan
-            
-    else:
+    # --- 4. Normalizar Posicionamentos para a Origem (0,0) ---
+    if not pending_placements:
         print("[INFO] Nenhum item ou plano para o layout. Retornando layout vazio e lista de falhas.")
         # Se não há entidades, o layout é considerado vazio, o que é um cenário de falha para a geração do DXF.
-        # Levantamos a exceção aqui, pois não há nada para desenhar.
         raise NoEntitiesFoundError(f"Nenhum item ou plano válido para o layout do plano '{plan_name}'.")
 
-    # Ajustar todas as entidades para que o canto inferior esquerdo do layout seja (0,0)
-    offset_x_final = -min_x_layout
-    offset_y_final = -min_y_layout
+    layout_width = layout_max_x - layout_min_x
+    layout_height = layout_max_y - layout_min_y
+
+    if layout_width == 0.0 and layout_height == 0.0:
+        print("[WARN] Bounding box final do layout do plano ainda é 0x0. Pode haver entidades sem geometria. Usando dimensões mínimas.")
+        # Não levantamos NoEntitiesFoundError aqui, pois queremos que o DXF seja gerado
+        # (mesmo que com problemas visuais).
+        layout_width = MARGEM_ESQUERDA * 2 + 100 # Exemplo de largura mínima
+        layout_height = MARGEM_INFERIOR * 2 + 100 # Exemplo de altura mínima
 
-    final_entities_with_coords = []
-    for ent, current_x, current_y in all_relative_entities_with_coords:
-        new_ent = ent.copy() # Copia novamente para não modificar a referência original
-        new_ent.translate(offset_x_final, offset_y_final, 0)
-        final_entities_with_coords.append((new_ent, current_x + offset_x_final, current_y + offset_y_final))
+    # Ajustar todos os posicionamentos para que o canto inferior esquerdo do layout
+    # seja (0,0). Como cada posicionamento é só um ponto de inserção de bloco, o
+    # ajuste é aritmética pura — nenhuma entidade é copiada ou transladada aqui.
+    offset_x_final = -layout_min_x
+    offset_y_final = -layout_min_y
 
-    layout_width = max_x_layout - min_x_layout
-    layout_height = max_y_layout - min_y_layout
+    final_placements = [
+        (block_name, x + offset_x_final, y + offset_y_final)
+        for block_name, x, y in pending_placements
+    ]
 
     print(f"[INFO] Layout do plano '{plan_name}' gerado. Dimensões: {layout_width:.2f}x{layout_height:.2f} mm")
-    return final_entities_with_coords, layout_width, layout_height, failed_ids_current_plan
+    return final_placements, layout_width, layout_height, failed_ids_current_plan
 
 print("DEBUG: dxf_layout_engine.py - generate_single_plan_layout_data() definida.")
 print("DEBUG: dxf_layout_engine.py - Fim do carregamento do módulo.")
@@ -1,57 +1,64 @@
 import ezdxf
+import re
+import weakref
+from functools import lru_cache
+from ezdxf import bbox # Módulo de bounding box do ezdxf (com suporte a cache)
 from ezdxf.math import BoundingBox, Vec3 # Adiciona importação de BoundingBox e Vec3
 
+# Caches de bounding box, um por documento DXF. Os handles de entidade (a chave
+# usada pelo bbox.Cache) só são únicos dentro de um mesmo documento, então um
+# cache único compartilhado misturaria entidades de arquivos diferentes.
+# WeakKeyDictionary libera o cache junto com o documento.
+_BBOX_CACHES = weakref.WeakKeyDictionary()
+
+def _obter_bbox_cache(msp):
+    """Retorna o bbox.Cache do documento dono do modelspace (ou None se não houver doc)."""
+    doc = getattr(msp, 'doc', None)
+    if doc is None:
+        return None
+    cache = _BBOX_CACHES.get(doc)
+    if cache is None:
+        cache = bbox.Cache()
+        _BBOX_CACHES[doc] = cache
+    return cache
+
+# Formato do SKU: 7 grupos separados por '-'; captura apenas os grupos usados
+# (1-formato, 2-tamanho, 3-furo, 5-cor). Um único match em C valida o formato
+# e extrai os campos, sem alocar a lista intermediária de um split completo.
+_SKU_RE = re.compile(r'^([^-]*)-([^-]*)-([^-]*)-[^-]*-([^-]*)-[^-]*-[^-]*$')
+
+@lru_cache(maxsize=4096)
 def parse_sku(sku: str):
     """
     Analisa a string SKU e extrai as informações relevantes.
     Exemplo: PLAC-3010-2FH-AC-DOU-070-00000
     Grupos: 1-formato, 2-tamanho, 3-furo, 4-material, 5-cor, 6-quantidade, 7-estilo da arte
+    O resultado é memoizado: SKUs repetidos no mesmo lote não refazem o parse
+    (e o aviso de formato inválido é emitido uma única vez por SKU).
     """
-    parts = sku.split('-')
-    if len(parts) != 7:
+    match = _SKU_RE.match(sku)
+    if match is None:
         print(f"[WARN] SKU '{sku}' não está no formato esperado (7 grupos).")
         return None, None, None, None # Retorna None para todos os valores se o formato não for o esperado
 
-    # Extrai os novos campos
-    dxf_format = parts[0] # Grupo 1: formato
-    dxf_size = parts[1]   # Grupo 2: tamanho
-    hole_type = parts[2]  # Grupo 3: tipo de furo
-    color_code = parts[4] # Grupo 5: código da cor
-
-    return dxf_format, dxf_size, hole_type, color_code
+    # (formato, tamanho, furo, cor)
+    return match.group(1, 2, 3, 4)
 
 def calcular_bbox_dxf(msp):
     """
     Calcula o bounding box (caixa delimitadora) de todas as entidades no modelspace de um DXF.
     Retorna (min_x, min_y, max_x, max_y).
-    Esta versão itera sobre as entidades e usa BoundingBox para maior robustez.
+    Esta versão usa ezdxf.bbox.extents com um cache por documento, para que
+    bboxes de entidades já vistas não sejam recalculadas.
     """
-    bbox_union = BoundingBox() # Inicializa uma caixa delimitadora vazia
-    found_any_entity = False # Flag para verificar se alguma entidade foi processada
-
-    for e in msp:
-        found_any_entity = True # Encontrou pelo menos uma entidade
-        try:
-            # Tenta obter a caixa delimitadora da entidade
-            entity_bbox = e.bbox()
-            
-            if entity_bbox.is_empty:
-                # Se a bbox da entidade for vazia, pula para a próxima
-                continue
-
-            # Adiciona os pontos extremos da bbox da entidade à bbox de união
-            bbox_union.extend(entity_bbox.extmin)
-            bbox_union.extend(entity_bbox.extmax)
-
-        except Exception as err:
-            # Ignora entidades que causam erro no cálculo da bbox
-            pass
-
-    if not found_any_entity:
-        print(f"[WARN] Nenhuma entidade encontrada no modelspace para calcular bbox. Retornando 0,0,0,0.")
-        return 0, 0, 0, 0
+    # fast=True usa os pontos de controle das curvas em vez de achatá-las em
+    # centenas de segmentos. Para as chapas cortadas (linhas/arcos/polilinhas)
+    # o resultado é o mesmo, sem o custo de flattening das Béziers.
+    bbox_union = bbox.extents(msp, fast=True, cache=_obter_bbox_cache(msp))
 
-    if bbox_union.is_empty:
+    # Atenção: is_empty é True para geometria 2D (extensão zero em Z),
+    # então o teste correto de "nenhum dado" é has_data.
+    if not bbox_union.has_data:
         print(f"[WARN] Bounding box união está vazio (provavelmente todas as entidades tinham bbox vazio ou erro). Retornando 0,0,0,0.")
         return 0, 0, 0, 0
 
@@ -1,10 +1,12 @@
+import io
 import os
 import json
 import datetime
+import tempfile
 import re # Importar módulo de expressões regulares
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, MediaIoBaseDownload
 from googleapiclient.errors import HttpError
 
 # Carrega credenciais direto da variável de ambiente
@@ -26,18 +28,28 @@ drive_service = build('drive', 'v3', credentials=creds)
 
 DEFAULT_FOLDER_ID = "1fLWrdK6MUhbeyBDvWHjz-2bTmZ2GB0ap"
 
+# Retentativas automáticas por chunk em caso de erro transitório de rede
+# (connection reset, 5xx). Com os downloads em paralelo, um soluço de rede
+# derrubaria um item inteiro sem isso.
+NUM_RETRIES_TRANSFERENCIA = 3
 
-def baixar_arquivo_drive(file_id: str, nome_arquivo_local: str, drive_folder_id: str = DEFAULT_FOLDER_ID):
+
+def baixar_arquivo_drive(file_id: str, nome_arquivo_local: str, drive_folder_id: str = DEFAULT_FOLDER_ID, dir_destino: str = None):
     """
     Baixa um arquivo do Google Drive usando seu ID.
-    Salva o arquivo em um caminho temporário local e retorna esse caminho.
+    Salva o arquivo em um caminho temporário local (ou em 'dir_destino', se
+    fornecido) e retorna esse caminho.
     """
-    local_path = f"/tmp/{nome_arquivo_local}"
+    local_path = os.path.join(dir_destino or tempfile.gettempdir(), nome_arquivo_local)
     try:
         request = drive_service.files().get_media(fileId=file_id)
+        # Faz o download em chunks direto para o arquivo, em vez de carregar
+        # o corpo inteiro em memória com request.execute().
         with open(local_path, 'wb') as f:
-            data = request.execute()
-            f.write(data)
+            downloader = MediaIoBaseDownload(f, request)
+            done = False
+            while not done:
+                _status, done = downloader.next_chunk(num_retries=NUM_RETRIES_TRANSFERENCIA)
         print(f"[INFO] Arquivo '{nome_arquivo_local}' (ID: {file_id}) baixado para '{local_path}'.")
         return local_path
     except HttpError as error:
@@ -49,6 +61,30 @@ def baixar_arquivo_drive(file_id: str, nome_arquivo_local: str, drive_folder_id:
         raise Exception(f"Erro inesperado ao baixar arquivo com ID '{file_id}': {e}")
 
 
+def baixar_arquivo_drive_bytes(file_id: str, drive_folder_id: str = DEFAULT_FOLDER_ID) -> bytes:
+    """
+    Baixa um arquivo do Google Drive direto para a memória e retorna seus bytes,
+    sem passar pelo disco. Útil quando o conteúdo será analisado em seguida
+    (ex: parse de DXF), evitando uma escrita e uma releitura do arquivo inteiro.
+    """
+    try:
+        request = drive_service.files().get_media(fileId=file_id)
+        buf = io.BytesIO()
+        downloader = MediaIoBaseDownload(buf, request)
+        done = False
+        while not done:
+            _status, done = downloader.next_chunk(num_retries=NUM_RETRIES_TRANSFERENCIA)
+        print(f"[INFO] Arquivo (ID: {file_id}) baixado em memória ({buf.tell()} bytes).")
+        return buf.getvalue()
+    except HttpError as error:
+        if error.resp.status == 404:
+            raise FileNotFoundError(f"Arquivo com ID '{file_id}' não encontrado no Drive.")
+        else:
+            raise Exception(f"Erro ao baixar arquivo com ID '{file_id}': {error}")
+    except Exception as e:
+        raise Exception(f"Erro inesperado ao baixar arquivo com ID '{file_id}': {e}")
+
+
 def buscar_arquivo_personalizado_por_id_e_sku(target_id: str, sku: str, drive_folder_id: str = DEFAULT_FOLDER_ID):
     """
     Busca um arquivo no Google Drive que contenha o ID (ex: XXXX) e "Arquivo Personalizado"
@@ -80,15 +116,75 @@ def buscar_arquivo_personalizado_por_id_e_sku(target_id: str, sku: str, drive_fo
         raise Exception(f"Erro inesperado ao buscar arquivo personalizado para ID '{target_id}': {e}")
 
 
+def buscar_arquivos_personalizados_em_lote(target_ids, drive_folder_id: str = DEFAULT_FOLDER_ID, tamanho_lote: int = 50):
+    """
+    Versão em lote de buscar_arquivo_personalizado_por_id_e_sku: uma única
+    chamada files.list (por grupo de ~50 IDs com cláusulas 'or') em vez de uma
+    chamada por item. Retorna um dict {target_id: (file_id, nome_no_drive)};
+    IDs sem arquivo correspondente simplesmente não aparecem no resultado.
+    """
+    resultados = {}
+    ids_unicos = list(dict.fromkeys(target_ids)) # Remove duplicados preservando a ordem
+
+    for i in range(0, len(ids_unicos), tamanho_lote):
+        lote = ids_unicos[i:i + tamanho_lote]
+        clausulas_nome = " or ".join(f"name contains '{tid}'" for tid in lote)
+        query = (
+            f"'{drive_folder_id}' in parents and ({clausulas_nome}) "
+            f"and name contains 'Arquivo Personalizado' and mimeType != 'application/vnd.google-apps.folder'"
+        )
+        try:
+            response = drive_service.files().list(q=query, fields="files(id, name)", pageSize=1000).execute()
+            files = response.get('files', [])
+        except HttpError as error:
+            raise Exception(f"Erro ao buscar arquivos personalizados em lote: {error}")
+
+        for tid in lote:
+            pattern = re.compile(rf"^{re.escape(tid)}\s*-\s*Arquivo Personalizado.*\.dxf$", re.IGNORECASE)
+            for f in files:
+                if pattern.match(f['name']):
+                    resultados[tid] = (f['id'], f['name'])
+                    break
+
+    return resultados
+
+
 def upload_to_drive(caminho_arquivo_local: str, nome_arquivo_drive: str, mime_type: str, drive_folder_id: str = DEFAULT_FOLDER_ID):
     """
     Faz upload de um arquivo para o Google Drive e retorna sua URL pública.
     """
     file_metadata = {'name': nome_arquivo_drive, 'parents': [drive_folder_id]}
-    media = MediaFileUpload(caminho_arquivo_local, mimetype=mime_type)
-    
+    # resumable=True envia o arquivo em chunks numa sessão resumível, em vez de
+    # um único POST multipart com o corpo inteiro em memória. Para os DXFs
+    # grandes de planos isso reduz o pico de memória e permite retomar o envio.
+    media = MediaFileUpload(caminho_arquivo_local, mimetype=mime_type, resumable=True)
+
+    try:
+        file = drive_service.files().create(body=file_metadata, media_body=media, fields="id").execute(num_retries=NUM_RETRIES_TRANSFERENCIA)
+        drive_service.permissions().create(
+            fileId=file.get('id'), body={'role':'reader','type':'anyone'}
+        ).execute()
+        public_url = f"https://drive.google.com/file/d/{file.get('id')}/view"
+        print(f"[INFO] Arquivo '{nome_arquivo_drive}' enviado ao Drive: {public_url}")
+        return public_url
+    except HttpError as error:
+        raise Exception(f"Erro ao fazer upload do arquivo '{nome_arquivo_drive}': {error}")
+    except Exception as e:
+        raise Exception(f"Erro inesperado ao fazer upload do arquivo '{nome_arquivo_drive}': {e}")
+
+
+def upload_to_drive_bytes(stream, nome_arquivo_drive: str, mime_type: str, drive_folder_id: str = DEFAULT_FOLDER_ID):
+    """
+    Faz upload de um conteúdo em memória (stream binário, ex: BytesIO) para o
+    Google Drive e retorna sua URL pública. Evita gravar o arquivo em disco só
+    para o upload relê-lo em seguida.
+    """
+    file_metadata = {'name': nome_arquivo_drive, 'parents': [drive_folder_id]}
+    stream.seek(0)
+    media = MediaIoBaseUpload(stream, mimetype=mime_type, resumable=True)
+
     try:
-        file = drive_service.files().create(body=file_metadata, media_body=media, fields="id").execute()
+        file = drive_service.files().create(body=file_metadata, media_body=media, fields="id").execute(num_retries=NUM_RETRIES_TRANSFERENCIA)
         drive_service.permissions().create(
             fileId=file.get('id'), body={'role':'reader','type':'anyone'}
         ).execute()
@@ -3,13 +3,15 @@ from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List, Optional, Tuple, Any
+import io
 import os
 import datetime
+from operator import attrgetter
 import ezdxf # Importa ezdxf aqui
 
 # Importações das funções de composição DXF e de interação com o Google Drive
 from dxf_layout_engine import generate_single_plan_layout_data, FOLHA_LARGURA_MM, ESPACAMENTO_LINHA_COR, NoEntitiesFoundError # Importa a nova função, constantes e a exceção
-from google_drive_utils import upload_to_drive, mover_arquivos_antigos, buscar_arquivo_personalizado_por_id_e_sku, esvaziar_lixeira_drive, deletar_todos_os_arquivos
+from google_drive_utils import upload_to_drive, upload_to_drive_bytes, mover_arquivos_antigos, buscar_arquivo_personalizado_por_id_e_sku, esvaziar_lixeira_drive, deletar_todos_os_arquivos
 
 app = FastAPI()
 
@@ -62,14 +64,19 @@ class EntradaComposicao(BaseModel):
     id_pasta_entrada_drive: str = Field(..., description="ID da pasta do Google Drive de onde os arquivos DXF personalizados são lidos.")
     id_pasta_saida_drive: str = Field(..., description="ID da pasta do Google Drive onde o DXF gerado será salvo.")
     output_filename: Optional[str] = Field(None, description="Nome do arquivo DXF de saída. Se não fornecido, será gerado automaticamente.")
+    dxf_binario: bool = Field(False, description="Se True, salva o DXF no formato binário (menor e mais rápido de gravar/enviar). Use apenas se o software de corte aceitar DXF binário.")
 
 
 @app.post("/compor-plano")
-async def compor_plano(entrada: EntradaComposicao):
+def compor_plano(entrada: EntradaComposicao):
     """
     Endpoint para compor um novo arquivo DXF combinando múltiplos planos de corte,
     organizando-os verticalmente. O arquivo DXF resultante é enviado para a pasta
     de saída especificada no Google Drive.
+
+    Definido como função síncrona (sem async) de propósito: o FastAPI a executa
+    no seu threadpool, então a composição pesada (ezdxf + Drive) não bloqueia o
+    event loop e requisições de composição podem rodar em paralelo.
     """
     if not entrada.plans:
         raise HTTPException(status_code=400, detail="Nenhum plano fornecido para composição.")
@@ -91,44 +98,50 @@ async def compor_plano(entrada: EntradaComposicao):
     all_failed_ids = [] # Lista para coletar todos os IDs de arquivo que falharam em qualquer plano
 
     # Ordena os planos pelo nome para garantir uma ordem consistente (ex: 01, 02, A, B)
-    sorted_plans = sorted(entrada.plans, key=lambda p: p.plan_name)
+    sorted_plans = sorted(entrada.plans, key=attrgetter('plan_name'))
+
+    # Cache de itens compartilhado entre os planos desta requisição:
+    # (id_arquivo_drive, sku) -> dimensões do bbox. O mesmo item repetido em
+    # mais de um plano é buscado/baixado/analisado uma única vez.
+    item_cache = {}
 
     try:
         for i, plan_data in enumerate(sorted_plans):
             print(f"[INFO] Processando plano '{plan_data.plan_name}' ({i+1}/{len(sorted_plans)})...")
             
             try:
-                # Gera os dados do layout para um único plano
-                # Agora retorna também a lista de IDs de arquivos que falharam neste plano
-                entities_with_relative_coords, layout_width, layout_height, failed_ids_current_plan = \
+                # Gera os posicionamentos de blocos do layout para um único plano.
+                # Os blocos são registrados diretamente no documento principal (doc);
+                # retorna também a lista de IDs de arquivos que falharam neste plano.
+                block_placements, layout_width, layout_height, failed_ids_current_plan = \
                     generate_single_plan_layout_data(
                         file_ids_and_skus=[item.model_dump() for item in plan_data.items],
                         plan_name=plan_data.plan_name,
-                        drive_folder_id=entrada.id_pasta_entrada_drive
+                        drive_folder_id=entrada.id_pasta_entrada_drive,
+                        doc=doc,
+                        item_cache=item_cache
                     )
-                
+
                 # Adiciona os IDs falhos deste plano à lista geral de falhas
                 all_failed_ids.extend(failed_ids_current_plan)
 
-                # Se a função retornou, mas não há entidades (após pular falhas),
+                # Se a função retornou, mas não há posicionamentos (após pular falhas),
                 # isso significa que o plano não pôde ser gerado.
-                if not entities_with_relative_coords:
+                if not block_placements:
                     print(f"[WARN] Plano '{plan_data.plan_name}' não gerou entidades visíveis após processar itens. Pulando este plano.")
                     # Não levantamos um erro fatal aqui, pois queremos continuar com outros planos.
-                    continue 
+                    continue
 
                 # Atualiza a largura máxima geral do documento
                 max_overall_width = max(max_overall_width, layout_width)
 
-                # Adiciona as entidades do plano atual ao modelspace principal, com o offset vertical
-                for ent, x_rel, y_rel in entities_with_relative_coords:
+                # Insere as referências de bloco do plano atual no modelspace principal,
+                # com o offset vertical global aplicado direto no ponto de inserção.
+                for block_name, x_rel, y_rel in block_placements:
                     # O (x_rel, y_rel) já é relativo ao canto inferior esquerdo do layout do plano.
-                    # Precisamos transladar para a posição global no documento principal.
                     # current_y_offset_global é a base Y para o plano atual.
-                    new_ent = ent.copy() # Copia a entidade novamente para o novo documento
-                    new_ent.translate(0, current_y_offset_global, 0) # Aplica o offset vertical
-                    msp.add_entity(new_ent)
-                    
+                    msp.add_blockref(block_name, insert=(x_rel, y_rel + current_y_offset_global))
+
                 print(f"[DEBUG] Plano '{plan_data.plan_name}' adicionado ao DXF principal na altura Y: {current_y_offset_global:.2f} mm.")
 
                 # Atualiza o offset Y global para o próximo plano
@@ -165,26 +178,28 @@ async def compor_plano(entrada: EntradaComposicao):
             plan_names_in_filename = " - ".join(p.plan_name for p in sorted_plans)
             output_dxf_name = f"Plano de Gravação {plan_names_in_filename} {timestamp}.dxf"
 
-        # Caminho temporário para salvar localmente antes do upload
-        caminho_saida_dxf = f"/tmp/{output_dxf_name}"
-
-        os.makedirs(os.path.dirname(caminho_saida_dxf) or '.', exist_ok=True)
-        doc.saveas(caminho_saida_dxf)
-        print(f"[INFO] DXF de saída salvo: {caminho_saida_dxf}")
-        
-        # Faz o upload do arquivo DXF gerado para o Google Drive
-        url_dxf = upload_to_drive(
-            caminho_saida_dxf,
-            os.path.basename(caminho_saida_dxf),
+        # Serializa o DXF direto em memória e envia o buffer ao Drive, sem
+        # gravar e reler o arquivo inteiro no disco.
+        # O formato binário grava os doubles crus em vez de formatar cada
+        # coordenada como texto: arquivo menor e mais rápido de gravar/enviar.
+        # Fica atrás de um flag porque nem todo software de corte lê DXF binário.
+        if entrada.dxf_binario:
+            buffer_saida = io.BytesIO()
+            doc.write(buffer_saida, fmt='bin')
+        else:
+            texto_saida = io.StringIO()
+            doc.write(texto_saida, fmt='asc')
+            buffer_saida = io.BytesIO(texto_saida.getvalue().encode(doc.output_encoding))
+        print(f"[INFO] DXF de saída serializado em memória: '{output_dxf_name}' ({buffer_saida.getbuffer().nbytes} bytes, formato {'binário' if entrada.dxf_binario else 'ASCII'})")
+
+        # Faz o upload do conteúdo gerado para o Google Drive
+        url_dxf = upload_to_drive_bytes(
+            buffer_saida,
+            output_dxf_name,
             "application/dxf",
             entrada.id_pasta_saida_drive
         )
 
-        # Limpa o arquivo temporário após o upload
-        if os.path.exists(caminho_saida_dxf):
-            os.remove(caminho_saida_dxf)
-            print(f"[INFO] Arquivo temporário DXF removido: {caminho_saida_dxf}")
-
         print(f"[INFO] Composição de múltiplos planos concluída com sucesso.")
         return {
             "message": "Plano de corte DXF composto e enviado ao Google Drive com sucesso!",